@@ -1,32 +1,107 @@
 # PROGRAM ID: Conversion between list of dictionaries and Excel CSV.py / Excel CSV to & from dictionary list
 # Author: Rachel Bush, Date initiated: 12/7/2017
-# INSTALLATION: Python v3.6
-# REMARKS: This package provides a Python API for quickly reading out a .csv file into a list of ordered dictionaries in one line. This can
+# INSTALLATION: Python v3.7
+# REMARKS: This package provides a Python API for quickly reading out a .csv file into a list of dictionaries in one line. This can
 # be useful under circumstances where memory usage isn't that important, and the data is not being stored in a proper database. For example,
 # this package was created for a context in which the data is being sold via CSV.
 
-# This file contains a class for reading from a CSV file written in the Excel dialect, as a list of ordered dictionaries, and
-# writing back to the CSV file using ordered or unordered dictionaries. The class works the same in Python v3.5 as in v3.6, except .read()
-# returns records as a list of OrderedDicts instead of a list of unordered dictionaries. You must specify a list of field names because
-# dictionaries are allowed to omit key-value pairs as a way of representing null values, unless you use ordered dictionaries and make sure
-# every record has the same number of fields by using None for null values.
+# This file contains a class for reading from a CSV file written in the Excel dialect, as a list of dictionaries, and writing back to the
+# CSV file using dictionaries. Python v3.7+ is required because the class relies on dictionaries keeping their insertion order, so plain
+# dictionaries are used instead of OrderedDicts. You must specify a list of field names because dictionaries are allowed to omit key-value
+# pairs as a way of representing null values, unless you make sure every record has the same keys in the same order by using None for null
+# values.
 
+import contextlib
 import csv
+import functools
+import io
+import mmap
+import multiprocessing
+import operator
 import os
-from collections import OrderedDict
+import re
+import shutil
+
+# Files which are read or written in full use a 1 MiB buffer instead of the 8 KiB default, so large files take far fewer system calls.
+BUFFER_SIZE = 1 << 20
+
+# ExcelCSV.read(parallel=True) only uses worker processes for files at least this large, because for smaller files starting the processes
+# takes longer than parsing.
+PARALLEL_READ_THRESHOLD = 10 * 1024 * 1024
+
+# Return the byte offsets at which a memory-mapped file can be split into count chunks of whole records. The first offset is the end of the
+# header row, and the last offset is the end of the file. A line break inside a quoted value doesn't end a record. In the Excel dialect,
+# quotes within a value are doubled, so a line break ends a record only if it is preceded by an even number of quotes.
+def _get_record_boundaries(mapped_file, count):
+    size = len(mapped_file)
+    boundaries = []
+    scanned = 0 # Quotes have been counted up to this offset.
+    quotes = 0
+    for target in range(0, size, max(1, -(-size // count))):
+        if target < scanned:
+            continue
+        while True:
+            line_end = mapped_file.find(b'\n', max(target, scanned))
+            if line_end == -1:
+                return boundaries + [size]
+            quotes += mapped_file[scanned:line_end + 1].count(b'"')
+            scanned = line_end + 1
+            if quotes % 2 == 0:
+                break
+        boundaries.append(scanned)
+    return boundaries + [size]
+
+# Whole records in which every quote belongs to a quoted field, i.e. opens it at the start of the field, closes it, or is doubled within it.
+# _get_record_boundaries() relies on this. A quote inside an unquoted field, as in 5'11", is read by csv.reader as a literal character but
+# still counted by the splitter, so every later boundary would be off. Checking that each chunk matches finds the first such quote, because
+# the boundaries before it are still correct, so the chunk containing it starts at a real record and fails at that quote.
+_QUOTED_FIELD = rb'"[^"]*(?:""[^"]*)*"'
+_UNQUOTED_FIELD = rb'[^",\r\n]*'
+_FIELD = rb'(?:' + _QUOTED_FIELD + rb'|' + _UNQUOTED_FIELD + rb')'
+_SPLITTABLE_RECORDS = re.compile(rb'(?:' + _FIELD + rb'(?:,' + _FIELD + rb')*(?:\r?\n|\Z))*')
+
+# Parse the records between two byte offsets of a file. This is the worker for ExcelCSV.read(parallel=True), so it's a module-level function
+# which can be pickled. If the chunk's quotes don't match _SPLITTABLE_RECORDS, the chunk boundaries can't be trusted, so return None.
+def _read_records_in_range(task):
+    path, start, end, fieldnames = task
+    with open(path, 'rb') as csv_infile:
+        csv_infile.seek(start)
+        chunk = csv_infile.read(end - start)
+    if _SPLITTABLE_RECORDS.fullmatch(chunk) is None:
+        return None
+    return list(csv.DictReader(io.StringIO(chunk.decode('utf-8'), newline=''), fieldnames))
+
+# Read the header row of a file as a tuple of field names. Batch scripts often construct many ExcelCSV instances for the same file, so the
+# result is cached. The modification time and size are part of the key so that an edited file is read again, and the class clears the
+# cache whenever it writes a header itself, in case an edit doesn't change the size within the modification time's resolution.
+@functools.lru_cache(maxsize=128)
+def _read_header(path, mtime_ns, size):
+    # Use UTF-8 so that scraped content, almost universally in UTF-8, which contains non-ASCII characters such as /x81, will not
+    # cause an exception. The -sig suffix tells open() to add a Byte Order Marker (BOM) invented by Microsoft, consisting of three
+    # unlikely characters. Microsoft Excel pre-2007 can't autodetect UTF-8, but 2007+ versions will be able to autodetect it if the
+    # BOM is present. (Though other parts of the project reference 'utf-8-sig', this is the only place in the project where I
+    # explain this.)
+    with open(path, 'r', encoding='utf-8-sig', newline='') as csv_infile:
+        # An empty file has no field names yet, the same as a file which doesn't exist.
+        return tuple(next(csv.reader(csv_infile), ()))
 
 # Simulate a CSV, written in the Excel dialect and containing field headers in the first row. This class supports reading as a list of dictionaries.
 # Creating an instance: spreadsheet=ExcelCSV(path)
 # Reading:              list_of_records = spreadsheet.read()
+#                       for record in spreadsheet.iter_records(): reads one record at a time.
+#                       columns = spreadsheet.read_columns() reads a dictionary mapping each field name to a list of its values.
+#                       table = spreadsheet.read_arrow() reads into a pyarrow Table, if pyarrow is installed.
 # Writing:              spreadsheet.write(list_of_records, output_path=None)
-#                       ExcelCSV(path, list_of_records) is a shortcut for constructing and writing to the file if the dictionaries are ordered.
-#                       ExcelCSV(path, list_of_records, fieldnames) is a shortcut for constructing and writing to the file if the dictionaries are unordered.
+#                       ExcelCSV(path, list_of_records) is a shortcut for constructing and writing to the file if every dictionary has the same keys in the same order.
+#                       ExcelCSV(path, list_of_records, fieldnames) is a shortcut for constructing and writing to the file if the dictionaries may omit keys.
 # Appending:            spreadsheet.append(list_of_records)
+#                       with spreadsheet.appender() as appender: appender.append(list_of_records) keeps the file open across batches.
 class ExcelCSV:
     # Construct the object using data from the file, or construct it using custom provided data and update the file to reflect the new state.
     def __init__(self, path, records=None, fieldnames=None):
-        self.path = '' # These are the only two attributes.
+        self.path = '' # These are the only two public attributes.
         self.fieldnames = None
+        self._batching_fields = False # True inside a batch_fields() block.
         
         self.path = path
         if records is None and fieldnames is None:
@@ -37,14 +112,14 @@ class ExcelCSV:
                 self.fieldnames = []
                 # If there are no records, do not create a .csv. The class assumes in this and the previous scenario that the user intends
                 # to add the records later.
-            elif isinstance(records[0], OrderedDict):
-                # Write to the file. All dictionaries must be ordered dictionaries and they must have the same keys, but the program doesn't validate this in
+            elif isinstance(records[0], dict):
+                # Write to the file. All dictionaries must have the same keys in the same order, but the program doesn't validate this in
                 # order to save on time spent coding. After writing the validation code, I'd need to test for the amount of time this adds
                 # to the process of writing to the file.
                 self.update_fieldnames_from_data(records)
                 self.write(records)
             else:
-                raise SyntaxError("Specify fieldnames when initializing with dict type records.")
+                raise SyntaxError("Records must be dictionaries.")
         elif records is None and fieldnames is not None:
             self.fieldnames = fieldnames
             self._update_fieldnames_in_file()
@@ -56,28 +131,22 @@ class ExcelCSV:
     # If the file exists, return a list of field names. If the file doesn't exist, return an empty list.
     def _get_fieldnames_from_file(self):
         try:
-            # Use UTF-8 so that scraped content, almost universally in UTF-8, which contains non-ASCII characters such as /x81, will not
-            # cause an exception. The -sig suffix tells open() to add a Byte Order Marker (BOM) invented by Microsoft, consisting of three
-            # unlikely characters. Microsoft Excel pre-2007 can't autodetect UTF-8, but 2007+ versions will be able to autodetect it if the
-            # BOM is present. (Though other parts of the project reference 'utf-8-sig', this is the only place in the project where I
-            # explain this.)
-            csv_infile = open(self.path, 'r', encoding='utf-8-sig', newline='')
-            reader = csv.reader(csv_infile)
-            fieldnames = reader.__next__()
-            csv_infile.close()
-            return fieldnames
+            stat = os.stat(self.path)
         except FileNotFoundError:
             return []
+        # The header is cached for as long as the file's modification time and size are unchanged. A new list is returned because the
+        # fieldnames attribute is edited in place.
+        return list(_read_header(os.path.abspath(self.path), stat.st_mtime_ns, stat.st_size))
 
-    # Update the fieldnames attribute, given a list of records of OrderedDict type or a single record. If a list is given, the function will
+    # Update the fieldnames attribute, given a list of records or a single record. If a list is given, the function will
     # use the first record, and it will assume its fields are the same as all other records in the list. Therefore, each record should indicate
     # a missing value using None or a null string instead of omitting the key.
     def update_fieldnames_from_data(self, data):
-        if isinstance(data, OrderedDict):
-            self.fieldnames = list(data.keys())
+        if isinstance(data, dict):
+            self.fieldnames = list(data)
         else:
             if len(data) > 0:
-                self.fieldnames = list(data[0].keys())
+                self.fieldnames = list(data[0])
             # If the length of the list of records is 0, then leave the field names unaltered.
             # The length of the list may be 0 for reasons external to the class, such as no
             # records being found during a search.
@@ -86,83 +155,255 @@ class ExcelCSV:
 
     # Prepend a field or fields to the fieldnames list. These methods are useful for adding data to an existing spreadsheet.
     def prepend_fields(self, *args):
-        for x in range(len(args)-1, -1, -1):
-            self.fieldnames.insert(0, args[x])
+        self.fieldnames[:0] = args
         self._update_fieldnames_in_file()
 
     # Append a field or fields to the fieldnames list.
     def append_fields(self, *args):
-        for x in range(len(args)):
-            self.fieldnames.append(args[x])
+        self.fieldnames.extend(args)
         self._update_fieldnames_in_file()
 
     # Insert a field or fields into the fieldnames list after a certain field name.
     def insert_fields_after(self, target_field, *args):
-        index = self.fieldnames.index(target_field)
-        for x in range(len(args)-1, -1, -1):
-            # Iterating backward is necessary to prevent the last field from being inserted at the beginning.
-            self.fieldnames.insert(index + 1, args[x])
+        index = self.fieldnames.index(target_field) + 1
+        self.fieldnames[index:index] = args
         self._update_fieldnames_in_file()
 
-    # Sync the fieldnames within the file with the fieldnames attribute.
+    # Make several field edits with a single update of the file. Each update rewrites the file, so inside the block, the methods above only
+    # change the fieldnames attribute, and the file's header is updated once when the block ends without an exception. If the block raises,
+    # the fieldnames attribute is restored to what it was when the outermost block began, so it still matches the file.
+    #     with spreadsheet.batch_fields():
+    #         spreadsheet.prepend_fields('ID')
+    #         spreadsheet.append_fields('Notes')
+    @contextlib.contextmanager
+    def batch_fields(self):
+        already_batching = self._batching_fields
+        fieldnames = list(self.fieldnames)
+        self._batching_fields = True
+        try:
+            yield self
+        except BaseException:
+            if not already_batching:
+                self.fieldnames = fieldnames
+            raise
+        finally:
+            self._batching_fields = already_batching
+        if not already_batching:
+            self._update_fieldnames_in_file()
+
+    # Sync the fieldnames within the file with the fieldnames attribute. Only the header row is replaced; the rest of the file is copied
+    # over as raw bytes without being parsed, or isn't touched at all if the new header row is the same length as the old one.
     def _update_fieldnames_in_file(self):
+        if self._batching_fields:
+            return self
         try:
-            # Upon opening a file for writing, its contents are erased, so it has to be opened for reading as well as writing in order to
-            # preserve the content aside from the fieldnames.
-            csv_infile = open(self.path, 'r', encoding='utf-8-sig', newline='')
-            csv_outfile = open(self.path+'_temp', 'w', encoding='utf-8-sig', newline='')
-            reader = csv.reader(csv_infile)
-            writer = csv.writer(csv_outfile)
-            first_row = True
-            for row in reader:
-                if first_row:
-                    # Transfer the new field names instead of the old header row.
-                    writer.writerow(self.fieldnames)
-                    first_row = False
-                else:
-                    writer.writerow(row)
-            csv_infile.close()
-            csv_outfile.close()
-            os.remove(self.path)
-            os.rename(self.path+'_temp', self.path)
+            csv_infile = open(self.path, 'rb', buffering=BUFFER_SIZE)
         except FileNotFoundError:
             # If there is no file, the function does nothing. This allows the function to be called routinely whenever the fieldnames are
             # being altered without writing to the file.
-            pass
+            return self
+        _read_header.cache_clear()
+        new_header = self._get_header_row().encode('utf-8-sig')
+        try:
+            with csv_infile:
+                # Read the old header row, including the BOM. A field name containing a line break is quoted, so the row continues until
+                # the quotes are balanced.
+                old_header = csv_infile.readline()
+                while old_header.count(b'"') % 2 == 1:
+                    line = csv_infile.readline()
+                    if not line:
+                        break
+                    old_header += line
+                if len(new_header) != len(old_header):
+                    # Upon opening a file for writing, its contents are erased, so the content aside from the fieldnames is copied to a
+                    # temporary file which then replaces the original.
+                    with open(self.path+'_temp', 'wb', buffering=BUFFER_SIZE) as csv_outfile:
+                        csv_outfile.write(new_header)
+                        shutil.copyfileobj(csv_infile, csv_outfile, BUFFER_SIZE)
+            if len(new_header) == len(old_header):
+                # The records stay where they are, so the new header row can simply be written over the old one.
+                with open(self.path, 'r+b') as csv_outfile:
+                    csv_outfile.write(new_header)
+            else:
+                os.replace(self.path+'_temp', self.path)
+        except BaseException:
+            ExcelCSV._remove_temp_file(self.path+'_temp')
+            raise
         return self
-    
-    def read(self):
+
+    # Delete the partial temporary file left by a rewrite which failed, if it got as far as creating one.
+    def _remove_temp_file(path):
         try:
-            csv_infile = open(self.path, 'r', encoding='utf-8-sig', newline='')
-            reader = csv.DictReader(csv_infile)
-            records = []
-            for row in reader:
-               records.append(row)
-            csv_infile.close()
-            return records
+            os.remove(path)
         except FileNotFoundError:
-            return []
+            pass
+
+    # Return the fieldnames attribute as a header row, quoted and terminated exactly as csv.writer does in the Excel dialect.
+    def _get_header_row(self):
+        header_row = io.StringIO()
+        csv.writer(header_row).writerow(self.fieldnames)
+        return header_row.getvalue()
+
+    # Read the records one at a time instead of building a list, so the whole file never has to be held in memory. If the file doesn't
+    # exist, nothing is yielded.
+    def iter_records(self):
+        try:
+            csv_infile = open(self.path, 'r', buffering=BUFFER_SIZE, encoding='utf-8-sig', newline='')
+        except FileNotFoundError:
+            return
+        with csv_infile:
+            yield from csv.DictReader(csv_infile)
+
+    # Read the file as columns: a dictionary mapping each field name to the list of its values, in the order of the records. Code which only
+    # looks at a few fields can work through their lists without touching the rest of the data. The rows are streamed into the lists, so
+    # only the columns are held in memory. As with read(), a value missing from a short row is None.
+    def read_columns(self):
+        columns = {field: [] for field in self.fieldnames}
+        appends = [columns[field].append for field in self.fieldnames]
+        for row in self._iter_rows(None):
+            for append, value in zip(appends, row):
+                append(value)
+        return columns
+
+    # Read the file as lists of values, skipping the header row, for methods which work with fields by position and don't need dictionaries.
+    # Blank lines are skipped, as csv.DictReader does. A row which is shorter than the fieldnames attribute, e.g. because fields were added
+    # to the header only, is padded with fill_value, so every field has a position in every row. The default null string matches what
+    # csv.DictWriter used to write for the missing values.
+    def _iter_rows(self, fill_value=''):
+        try:
+            csv_infile = open(self.path, 'r', buffering=BUFFER_SIZE, encoding='utf-8-sig', newline='')
+        except FileNotFoundError:
+            return
+        with csv_infile:
+            reader = csv.reader(csv_infile)
+            next(reader, None)
+            width = len(self.fieldnames)
+            for row in filter(None, reader):
+                if len(row) < width:
+                    row += [fill_value] * (width - len(row))
+                yield row
+
+    # With parallel=True, a file of at least PARALLEL_READ_THRESHOLD bytes is split into chunks which are parsed by a pool of worker
+    # processes. On platforms which start processes by spawning (Windows, macOS), the calling script needs an if __name__ == '__main__': guard.
+    def read(self, parallel=False):
+        if parallel:
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                return []
+            if size >= PARALLEL_READ_THRESHOLD:
+                return self._read_in_parallel()
+        return list(self.iter_records())
+
+    def _read_in_parallel(self):
+        processes = os.cpu_count() or 1
+        with open(self.path, 'rb') as csv_infile, mmap.mmap(csv_infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            # Use more chunks than processes, so that a process which finishes early can take another chunk.
+            offsets = _get_record_boundaries(mapped_file, processes * 4)
+            header = mapped_file[:offsets[0]]
+        if _SPLITTABLE_RECORDS.fullmatch(header) is None:
+            return list(self.iter_records())
+        fieldnames = next(csv.reader(io.StringIO(header.decode('utf-8-sig'), newline='')), [])
+        tasks = [(self.path, start, end, fieldnames) for start, end in zip(offsets, offsets[1:]) if start < end]
+        records = []
+        with multiprocessing.Pool(processes) as pool:
+            # imap() returns the chunks in file order.
+            for chunk_records in pool.imap(_read_records_in_range, tasks):
+                if chunk_records is None:
+                    # A quote inside an unquoted field put the boundaries in the wrong places, so read the file sequentially.
+                    return list(self.iter_records())
+                records.extend(chunk_records)
+        return records
+
+    # Read the file into a pyarrow Table, whose C++ parser is much faster than the csv module on large files. pyarrow is optional and is
+    # only imported here. Every column named in the file's header row is read as a string, and empty cells stay as null strings rather
+    # than nulls. Unlike read(), Arrow raises an error for a row with more or fewer values than the header row.
+    def read_arrow(self):
+        import pyarrow
+        import pyarrow.csv
+        try:
+            # The Arrow parser skips the BOM on its own.
+            csv_infile = open(self.path, 'rb')
+        except FileNotFoundError:
+            return pyarrow.table({field: pyarrow.array([], pyarrow.string()) for field in self.fieldnames})
+        # The column types come from the file's header row rather than the fieldnames attribute, which may differ from it, e.g. inside a
+        # batch_fields() block. Any column left out would have its type inferred.
+        fieldnames = self._get_fieldnames_from_file()
+        with csv_infile:
+            if len(fieldnames) == 0:
+                # Arrow rejects an empty file, but like read(), treat it the same as a file which doesn't exist.
+                return pyarrow.table({field: pyarrow.array([], pyarrow.string()) for field in self.fieldnames})
+            return pyarrow.csv.read_csv(csv_infile,
+                                        parse_options=pyarrow.csv.ParseOptions(newlines_in_values=True),
+                                        convert_options=pyarrow.csv.ConvertOptions(
+                                            column_types={field: pyarrow.string() for field in fieldnames},
+                                            strings_can_be_null=False, quoted_strings_can_be_null=False))
 
     # Write to the file. As a prerequisite, the fieldnames attribute must have been updated to reflect any field changes.
-    def write(self, records, output_path=None):
+    # fast=True skips the csv module's quoting checks and is only for callers who can guarantee that every value is a string containing no
+    # commas, double quotes or line breaks, e.g. IDs and numbers which have already been converted to strings.
+    def write(self, records, output_path=None, fast=False):
         if output_path is not None:
             self.path = output_path
-        csv_outfile = open(self.path, 'w', encoding='utf-8-sig', newline='')
-        writer = csv.DictWriter(csv_outfile, self.fieldnames)
-        writer.writeheader()
-        writer.writerows(records)
-        csv_outfile.close()
+        self._write_file(self.path, self._get_rows(records), fast)
         return self
 
+    # Write the header row and then the rows, which are lists of values in the order of the fieldnames attribute.
+    def _write_file(self, path, rows, fast=False, fieldnames=None):
+        if fieldnames is None:
+            fieldnames = self.fieldnames
+        _read_header.cache_clear()
+        # The BOM is written by hand so that the rest of the file can be encoded as plain UTF-8, which the io module does in C, instead of
+        # through the 'utf-8-sig' codec's Python-level encoder.
+        with open(path, 'w', buffering=BUFFER_SIZE, encoding='utf-8', newline='') as csv_outfile:
+            csv_outfile.write('\ufeff')
+            csv.writer(csv_outfile).writerow(fieldnames)
+            self._write_rows(csv_outfile, rows, fast)
+
+    # Write rows to an open file, either through csv.writer or, when fast is true, by joining the values with commas directly.
+    def _write_rows(self, csv_outfile, rows, fast):
+        if fast and len(self.fieldnames) > 1:
+            # With a single field, a null string would become a blank line, which readers skip, so csv.writer has to quote it.
+            csv_outfile.writelines(','.join(row) + '\r\n' for row in rows)
+        else:
+            csv.writer(csv_outfile).writerows(rows)
+
+    # Convert records to rows of values in the order of the fieldnames attribute, which csv.writer can write without the per-record
+    # translation csv.DictWriter does. As with csv.DictWriter, a missing key becomes a null string. Keys which aren't in the fieldnames
+    # attribute are ignored.
+    def _get_rows(self, records):
+        fieldnames = self.fieldnames
+        # Usually every record has every field, so the values are looked up by an operator.itemgetter(), which does it in C. itemgetter()
+        # needs at least one key and returns a lone value instead of a tuple for a single key, so those cases get a wrapper.
+        if len(fieldnames) > 1:
+            get_row = operator.itemgetter(*fieldnames)
+        elif len(fieldnames) == 1:
+            get_value = operator.itemgetter(fieldnames[0])
+            get_row = lambda record: (get_value(record),)
+        else:
+            get_row = lambda record: ()
+        for record in records:
+            try:
+                yield get_row(record)
+            except KeyError:
+                # The record omits a key to represent a null value.
+                yield [record.get(field, '') for field in fieldnames]
+
     # Append records to the file. As a prerequisite, the fieldnames attribute and the fields in the file must have been updated to reflect
-    # any field changes. I haven't used this in the project yet.
-    def append(self, records):
-        csv_outfile = open(self.path, 'a', encoding='utf-8-sig', newline='')
-        writer = csv.DictWriter(csv_outfile, self.fieldnames)
-        writer.writerows(records)
-        csv_outfile.close()
+    # any field changes. See write() for fast. I haven't used this in the project yet.
+    def append(self, records, fast=False):
+        # A file written by this class already starts with a BOM, so the appended rows are plain UTF-8. A missing or empty file gets the
+        # BOM first, as the 'utf-8-sig' codec would write at position 0.
+        with open(self.path, 'a', buffering=BUFFER_SIZE, encoding='utf-8', newline='') as csv_outfile:
+            if csv_outfile.tell() == 0:
+                csv_outfile.write('\ufeff')
+            self._write_rows(csv_outfile, self._get_rows(records), fast)
         return self
 
+    # Return an ExcelCSVAppender for appending many batches of records while keeping the file open. See ExcelCSVAppender for buffer_size.
+    def appender(self, buffer_size=BUFFER_SIZE):
+        return ExcelCSVAppender(self, buffer_size)
+
     # Set the path and, if the file still exists at the previously specified location, move the file. I haven't used this in the project yet.
     def set_path(self, path):
         self.path = path
@@ -172,15 +413,31 @@ class ExcelCSV:
 
     # The following methods operate on the spreadsheet while including reading and writing.
 
+    # Write rows which may still be streaming out of this file. They are written to a temporary file, so the source isn't erased while it
+    # is being read, and the temporary file then takes the place of the destination. If anything fails on the way, e.g. a filter function
+    # raises, the partial temporary file is removed and the destination is left as it was. If fieldnames is given, it is written as the
+    # header row and becomes the fieldnames attribute only once the rewrite has succeeded.
+    def _stream_write(self, rows, output_path=None, fieldnames=None):
+        destination = self.path if output_path is None else output_path
+        try:
+            self._write_file(destination+'_temp', rows, fieldnames=fieldnames)
+            os.replace(destination+'_temp', destination)
+        except BaseException:
+            ExcelCSV._remove_temp_file(destination+'_temp')
+            raise
+        self.path = destination
+        if fieldnames is not None:
+            self.fieldnames = fieldnames
+
     # Remove the specified field from the CSV. I haven't used this in the project yet.
     def remove_field(self, field, output_path=None):
-        input_list_of_records = self.read()
-        output_list_of_records = []
-        for record in input_list_of_records:
-            del record[field]
-            output_list_of_records.append(record)
-        self.fieldnames.remove(field)
-        self.write(output_list_of_records, output_path)
+        # The rows are never turned into dictionaries; the field's value is simply deleted from each row by its position.
+        index = self.fieldnames.index(field)
+        def rows_without_field():
+            for row in self._iter_rows():
+                del row[index]
+                yield row
+        self._stream_write(rows_without_field(), output_path, self.fieldnames[:index] + self.fieldnames[index + 1:])
 
     # 0. Given a field with categorical data (a limited number of choices for values), or a multiple choice field, split it into several
     # boolean fields. The fields will be null boolean field only when there is no data such that all fields are NULL.
@@ -202,28 +459,38 @@ class ExcelCSV:
     # Output: None.
     def convert_choice_field_to_boolean_field(self, original_field, possible_choices=None, new_field_names=None, delimiter=', ',
                                               checked_symbol='Y', unchecked_symbol='N', null_symbol='No data'):
-        list_of_records = self.read()
+        # The conversion only needs the original field's value in each row, so it works on rows by position without building dictionaries.
+        # Both passes pad short rows with null strings, e.g. when the original field was added to the header by append_fields(), so that
+        # every row has a value at the index and is rewritten at full width, as csv.DictWriter used to write it.
+        index = self.fieldnames.index(original_field)
         if possible_choices is None:
-            possible_choices = ExcelCSV._get_possible_choices(list_of_records, original_field, delimiter)
+            # Finding the choices takes a separate pass over the file, which reads only the original field's column.
+            possible_choices = ExcelCSV._get_possible_choices((row[index] for row in self._iter_rows('')), delimiter)
         if new_field_names is None:
             new_field_names = ExcelCSV._get_new_fields(possible_choices)
-        self.insert_fields_after(original_field, *new_field_names)
-        list_of_records = ExcelCSV._add_boolean_fields_to_records(list_of_records, original_field, possible_choices, new_field_names,
-                                                                  delimiter, checked_symbol, unchecked_symbol, null_symbol)
-        self.write(list_of_records)
-
-    # 1. Given a list of records and a single-choice (categorical data) field or a multiple-choice field, examine all of them to build a list of
-    # possible choice values.
-    def _get_possible_choices(list_of_records, original_field, delimiter):
-        possible_choices = []
-        for i in range(len(list_of_records)):
-            list_of_choices_for_record = list_of_records[i][original_field].split(delimiter)
-            for j in range(len(list_of_choices_for_record)):
-                if list_of_choices_for_record[j] != '':
+        # The fieldnames attribute changes only once the file has been rewritten with the new header, so a failed conversion leaves both
+        # as they were.
+        fieldnames = self.fieldnames[:index + 1] + list(new_field_names) + self.fieldnames[index + 1:]
+        rows = ExcelCSV._add_boolean_fields_to_rows(self._iter_rows(''), index, possible_choices, delimiter, checked_symbol, unchecked_symbol,
+                                                    null_symbol)
+        self._stream_write(rows, fieldnames=fieldnames)
+
+    # 1. Given the values of a single-choice (categorical data) field or a multiple-choice field, examine all of them to build a list of
+    # possible choice values. The choices are collected as keys of a dictionary, which keeps them in order of first appearance while making
+    # the check for an already seen choice O(1).
+    def _get_possible_choices(values, delimiter):
+        possible_choices = {}
+        for value in values:
+            if delimiter not in value:
+                # A single choice doesn't need a list from split().
+                if value != '':
                     # When none of the choices have been selected, the value will be an empty string, and that should be exempted from becoming the name of a new field.
-                    if list_of_choices_for_record[j] not in possible_choices:
-                        possible_choices.append(list_of_choices_for_record[j])
-        return possible_choices
+                    possible_choices[value] = None
+                continue
+            for choice in value.split(delimiter):
+                if choice != '':
+                    possible_choices[choice] = None
+        return list(possible_choices)
 
     # 2. Generate the new field names by appending a question mark to each possible choice value.
     def _get_new_fields(possible_choices):
@@ -232,30 +499,62 @@ class ExcelCSV:
             new_fields.append(possible_choices[x] + '?')
         return new_fields
 
-    # 3. Add the Boolean fields to the list of records by using the processed multiple choice field data.
-    def _add_boolean_fields_to_records(list_of_records, original_field, possible_choices, new_fields, delimiter,checked_symbol,
-                                       unchecked_symbol, null_symbol):
-        for i in range(len(list_of_records)):
-            if list_of_records[i][original_field] == null_symbol:
-                for j in range(len(new_fields)):
-                    list_of_records[i][new_fields[j]] = ''
+    # 3. Insert the Boolean values after the original field's value at the given index of each row by using the processed multiple choice
+    # field data, yielding the rows as they are converted.
+    def _add_boolean_fields_to_rows(rows, index, possible_choices, delimiter, checked_symbol, unchecked_symbol, null_symbol):
+        null_values = [''] * len(possible_choices)
+        for row in rows:
+            value = row[index]
+            if value == null_symbol:
+                row[index + 1:index + 1] = null_values
             else:
-                list_of_choices_for_record = list_of_records[i][original_field].split(delimiter)
-                for j in range(len(new_fields)):
-                    if possible_choices[j] in list_of_choices_for_record:
-                        list_of_records[i][new_fields[j]] = checked_symbol
-                    else:
-                        list_of_records[i][new_fields[j]] = unchecked_symbol                 
-        return list_of_records
+                # A set makes each check for a choice O(1) instead of a scan through the row's choices.
+                choices_for_row = set(value.split(delimiter)) if delimiter in value else {value}
+                row[index + 1:index + 1] = [checked_symbol if choice in choices_for_row else unchecked_symbol for choice in possible_choices]
+            yield row
 
     # Filter the records in the spreadsheet down to only those which make a Boolean function of the form
-    # function(record, *args, **kwargs) true.
+    # function(record, *args, **kwargs) true. The function is called once per record, so when filtering on field values, prefer passing
+    # a precompiled predicate such as filters.compile_matcher(fields_dict) over filters.matches_fields with fields_dict as an argument.
     # Input: function object, *args, **kwargs
     # Output: None
     def filter(self, function, *args, output_path=None, **kwargs):
-        input_list_of_records = self.read()
-        output_list_of_records = []
-        for record in input_list_of_records:
-            if function(record, *args, **kwargs):
-                output_list_of_records.append(record)
-        self.write(output_list_of_records, output_path)
+        if args or kwargs:
+            records = (record for record in self.iter_records() if function(record, *args, **kwargs))
+        else:
+            # The built-in filter() runs the loop in C, which leaves only the calls to the function itself in Python.
+            records = filter(function, self.iter_records())
+        self._stream_write(self._get_rows(records), output_path)
+
+# Append batches of records to an ExcelCSV's file while keeping the file open between batches. Instead of an open, a write and a close for
+# every call to ExcelCSV.append(), the rows collect in the file's buffer and reach the operating system in writes of up to buffer_size bytes.
+# The buffer is allocated once and reused for every batch. Set buffer_size to at least the serialized size of the largest expected batch;
+# a batch which doesn't fit is written directly instead, after flushing what is already buffered.
+# The same prerequisites as ExcelCSV.append() apply. Use it as a context manager so that the buffer is flushed and the file is closed:
+#     with spreadsheet.appender() as appender:
+#         for list_of_records in batches:
+#             appender.append(list_of_records)
+class ExcelCSVAppender:
+    def __init__(self, spreadsheet, buffer_size=BUFFER_SIZE):
+        self.spreadsheet = spreadsheet
+        self.buffer_size = buffer_size
+        self._csv_outfile = None
+
+    def __enter__(self):
+        self._csv_outfile = open(self.spreadsheet.path, 'a', buffering=self.buffer_size, encoding='utf-8', newline='')
+        # See ExcelCSV.append() for the BOM.
+        if self._csv_outfile.tell() == 0:
+            self._csv_outfile.write('\ufeff')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._csv_outfile is not None:
+            self._csv_outfile.close()
+            self._csv_outfile = None
+
+    # See ExcelCSV.write() for fast.
+    def append(self, records, fast=False):
+        if self._csv_outfile is None:
+            raise ValueError("ExcelCSVAppender.append() must be called inside a with block, e.g. with spreadsheet.appender() as appender:")
+        self.spreadsheet._write_rows(self._csv_outfile, self.spreadsheet._get_rows(records), fast)
+        return self
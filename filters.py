@@ -4,6 +4,8 @@
 # REMARKS: These are functions which filter dictionary records in various ways. They can be used by ExcelCSV's filter()
 # or Python's built-in filter.
 
+import operator
+
 # Given a dictionary record and a dictionary of field-value pairs, return True if all the record's matching fields have matching values.
 # Otherwise, return False. In place of a single value for a field-value pair, you can also use a list or tuple of qualifying values.
 def matches_fields(record, fields_dict):
@@ -17,3 +19,25 @@ def matches_fields(record, fields_dict):
             if record[field] != fields_dict[field]:
                 return False
     return True
+
+# Build a function equivalent to matches_fields(record, fields_dict) which does the per-field work once in advance. Lists and tuples of
+# qualifying values become frozensets, so membership doesn't require scanning the list. When every field has a single value, the whole
+# comparison is one operator.itemgetter() call and one tuple comparison, both of which run in C. Use it when the same fields_dict is checked
+# against many records, e.g. spreadsheet.filter(compile_matcher({'field': ['value 1', 'value 2']})).
+def compile_matcher(fields_dict):
+    spec = tuple((field, frozenset(value) if isinstance(value, (list, tuple)) else None, value)
+                 for field, value in fields_dict.items())
+    if len(spec) > 1 and all(value_set is None for field, value_set, value in spec):
+        get_values = operator.itemgetter(*fields_dict)
+        values = tuple(fields_dict.values())
+        return lambda record: get_values(record) == values
+
+    def matcher(record):
+        for field, value_set, value in spec:
+            if value_set is not None:
+                if record[field] not in value_set:
+                    return False
+            elif record[field] != value:
+                return False
+        return True
+    return matcher